@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-from typing import List, Tuple, Optional
+from typing import Optional
 
 @dataclass
 class SlackAlert:
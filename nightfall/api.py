@@ -4,22 +4,34 @@ nightfall.api
 ~~~~~~~~~~~~~
     This module provides a class which abstracts the Nightfall REST API.
 """
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextvars
 from datetime import datetime, timedelta
+from functools import partial
 import hmac
 import hashlib
+import json
 import logging
 import os
 from typing import List, Tuple, Optional
 
 import requests
-from requests.adapters import HTTPAdapter
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 from urllib3 import Retry
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from nightfall.alerts import AlertConfig
 from nightfall.detection_rules import DetectionRule, RedactionConfig
 from nightfall.exceptions import NightfallUserError, NightfallSystemError
 from nightfall.findings import Finding
 
+# Request and response bodies can be hundreds of KB, so debug logs only include this many characters of each.
+_LOG_BODY_MAX = 1024
+
 
 class Nightfall:
     PLATFORM_URL = "https://api.nightfall.ai"
@@ -29,12 +41,15 @@ class Nightfall:
     FILE_SCAN_COMPLETE_ENDPOINT = PLATFORM_URL + "/v3/upload/{0}/finish"
     FILE_SCAN_SCAN_ENDPOINT = PLATFORM_URL + "/v3/upload/{0}/scan"
 
-    def __init__(self, key: Optional[str] = None, signing_secret: Optional[str] = None):
+    def __init__(self, key: Optional[str] = None, signing_secret: Optional[str] = None,
+                 file_upload_concurrency: int = 1):
         """Instantiate a new Nightfall object.
         :param key: Your Nightfall API key. If None it will be read from the environment variable NIGHTFALL_API_KEY.
         :type key: str or None
         :param signing_secret: Your Nightfall signing secret used for webhook validation.
         :type signing_secret: str or None
+        :param file_upload_concurrency: The number of file chunks to upload in parallel when scanning files.
+        :type file_upload_concurrency: int
         """
         if key:
             self.key = key
@@ -45,17 +60,33 @@ class Nightfall:
             raise NightfallUserError("need an API key either in constructor or in NIGHTFALL_API_KEY environment var",
                                      40001)
 
+        if file_upload_concurrency < 1:
+            raise NightfallUserError("file_upload_concurrency must be at least 1", 40001)
+
         self.signing_secret = signing_secret
+        self.file_upload_concurrency = file_upload_concurrency
         self.logger = logging.getLogger(__name__)
         self.session = requests.Session()
         retries = Retry(total=5, allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"PATCH", "POST"})
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+        # Size the pool so that parallel chunk uploads each get a connection that is kept alive for reuse.
+        pool_size = max(DEFAULT_POOLSIZE, file_upload_concurrency)
+        self.session.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=pool_size))
         self.session.headers = {
             "Content-Type": "application/json",
             "User-Agent": "nightfall-python-sdk/1.4.1",
             'Authorization': f'Bearer {self.key}',
         }
 
+    def __enter__(self) -> "Nightfall":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the underlying HTTP session and release its pooled connections."""
+        self.session.close()
+
     def scan_text(self, texts: List[str], policy_uuids: List[str] = None, detection_rules: Optional[List[DetectionRule]] = None,
                   detection_rule_uuids: Optional[List[str]] = None, context_bytes: Optional[int] = None,
                   default_redaction_config: Optional[RedactionConfig] = None, alert_config: Optional[AlertConfig] = None) ->\
@@ -115,20 +146,25 @@ class Nightfall:
 
         _validate_response(response, 200)
 
-        parsed_response = response.json()
+        parsed_response = _loads(response)
 
         findings = [[Finding.from_dict(f) for f in item_findings] for item_findings in parsed_response["findings"]]
         return findings, parsed_response.get("redactedPayload")
 
     def _scan_text_v3(self, data: dict):
-        response = self.session.post(url=self.TEXT_SCAN_ENDPOINT_V3, json=data)
-
-        self.logger.debug(f"HTTP Request URL: {response.request.url}")
-        self.logger.debug(f"HTTP Request Body: {response.request.body}")
-        self.logger.debug(f"HTTP Request Headers: {response.request.headers}")
-        self.logger.debug(f"HTTP Status Code: {response.status_code}")
-        self.logger.debug(f"HTTP Response Headers: {response.headers}")
-        self.logger.debug(f"HTTP Response Text: {response.text}")
+        response = self.session.post(url=self.TEXT_SCAN_ENDPOINT_V3, data=_dumps(data))
+
+        # Skip building these messages, which touch the request and response bodies, unless they will be emitted.
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("HTTP Request URL: %s", response.request.url)
+            body = response.request.body or b""
+            self.logger.debug("HTTP Request Body (%d bytes): %s", len(body), body[:_LOG_BODY_MAX].decode(errors="replace"))
+            self.logger.debug("HTTP Request Headers: %s", response.request.headers)
+            self.logger.debug("HTTP Status Code: %s", response.status_code)
+            self.logger.debug("HTTP Response Headers: %s", response.headers)
+            # Decode only the logged prefix of each body; response.text would decode the whole response.
+            self.logger.debug("HTTP Response Text (%d bytes): %s", len(response.content),
+                              response.content[:_LOG_BODY_MAX].decode(errors="replace"))
 
         return response
 
@@ -163,7 +199,7 @@ class Nightfall:
 
         response = self._file_scan_initialize(location)
         _validate_response(response, 200)
-        result = response.json()
+        result = _loads(response)
         session_id, chunk_size = result['id'], result['chunkSize']
 
         uploaded = self._file_scan_upload(session_id, location, chunk_size)
@@ -180,7 +216,7 @@ class Nightfall:
                                         request_metadata=request_metadata,
                                         alert_config=alert_config)
         _validate_response(response, 200)
-        parsed_response = response.json()
+        parsed_response = _loads(response)
 
         return parsed_response["id"], parsed_response["message"]
 
@@ -188,34 +224,50 @@ class Nightfall:
         data = {
             "fileSizeBytes": os.path.getsize(location)
         }
-        response = self.session.post(url=self.FILE_SCAN_INITIALIZE_ENDPOINT, json=data)
+        response = self.session.post(url=self.FILE_SCAN_INITIALIZE_ENDPOINT, data=_dumps(data))
 
         return response
 
     def _file_scan_upload(self, session_id: str, location: str, chunk_size: int):
 
-        def read_chunks(fp, chunk_size):
-            ix = 0
-            while True:
-                data = fp.read(chunk_size)
-                if not data:
-                    break
-                yield ix, data
-                ix = ix + 1
-
         def upload_chunk(id, data, headers):
             response = self.session.patch(
                 url=self.FILE_SCAN_UPLOAD_ENDPOINT.format(id),
                 data=data,
                 headers=headers
             )
-            return response
+            # Validate here rather than returning the response, which would keep the chunk alive as its request body.
+            _validate_response(response, 204)
 
         with open(location, 'rb') as fp:
-            for ix, piece in read_chunks(fp, chunk_size):
-                headers = {"X-UPLOAD-OFFSET": str(ix * chunk_size)}
-                response = upload_chunk(session_id, piece, headers)
-                _validate_response(response, 204)
+            offset = 0
+            if self.file_upload_concurrency == 1:
+                # Upload on the caller's thread, keeping its context (e.g. tracing spans) and avoiding a pool.
+                for piece in iter(partial(fp.read, chunk_size), b''):
+                    upload_chunk(session_id, piece, {"X-UPLOAD-OFFSET": str(offset)})
+                    offset += len(piece)
+                    # Drop our reference so the uploaded chunk can be freed while the next one is read.
+                    del piece
+                return True
+
+            # Free a slot before reading the next chunk, so at most file_upload_concurrency chunks are held in memory,
+            # counting the one being read.
+            with ThreadPoolExecutor(max_workers=self.file_upload_concurrency) as executor:
+                pending = set()
+                for piece in iter(partial(fp.read, chunk_size), b''):
+                    headers = {"X-UPLOAD-OFFSET": str(offset)}
+                    # Run each upload in a copy of the caller's context, as executor threads do not inherit it.
+                    pending.add(executor.submit(contextvars.copy_context().run, upload_chunk, session_id, piece, headers))
+                    offset += len(piece)
+                    # Drop our reference so a finished chunk can be freed while the next one is read; for the same
+                    # reason the offset is tracked by hand, as enumerate() would hold on to its last item.
+                    del piece
+                    if len(pending) >= self.file_upload_concurrency:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                for future in wait(pending).done:
+                    future.result()
 
         return True
 
@@ -243,7 +295,7 @@ class Nightfall:
         if request_metadata:
             data["requestMetadata"] = request_metadata
 
-        response = self.session.post(url=self.FILE_SCAN_SCAN_ENDPOINT.format(session_id), json=data)
+        response = self.session.post(url=self.FILE_SCAN_SCAN_ENDPOINT.format(session_id), data=_dumps(data))
         return response
 
     def validate_webhook(self, request_signature: str, request_timestamp: str, request_data: str) -> bool:
@@ -276,6 +328,28 @@ class Nightfall:
 
 
 # Utility
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            # orjson rejects strings that are not valid UTF-8, such as lone surrogates left by surrogateescape
+            # decoding; the stdlib escapes those instead, so fall back to it rather than refusing the request.
+            pass
+    return json.dumps(obj).encode()
+
+
+def _loads(response: requests.Response):
+    try:
+        if orjson is not None:
+            return orjson.loads(response.content)
+        return json.loads(response.content)
+    except ValueError:
+        # Hand bodies the fast path cannot decode to requests, so a malformed body still raises
+        # requests.exceptions.JSONDecodeError (a RequestException), as response.json() always did.
+        return response.json()
+
+
 def _validate_response(response: requests.Response, expected_status_code: int):
     if response.status_code == expected_status_code:
         return
@@ -3,6 +3,8 @@ from dataclasses import dataclass
 
 from nightfall.detection_rules import Confidence
 
+_CONFIDENCE_BY_NAME = {c.name: c for c in Confidence}
+
 
 @dataclass
 class Range:
@@ -12,6 +14,8 @@ class Range:
     :param end: The end of the range.
     :type end: int
     """
+    __slots__ = ("start", "end")
+
     start: int
     end: int
 
@@ -40,6 +44,10 @@ class Finding:
         matched_detection_rules (List[str]): The list of inline detection rules that contained a detector that triggered
             a match.
     """
+    __slots__ = ("finding", "redacted_finding", "before_context", "after_context", "detector_name", "detector_uuid",
+                 "confidence", "byte_range", "codepoint_range", "row_range", "column_range", "commit_hash",
+                 "commit_author", "matched_detection_rule_uuids", "matched_detection_rules")
+
     finding: str
     redacted_finding: Optional[str]
     before_context: Optional[str]
@@ -65,7 +73,7 @@ class Finding:
             resp.get("afterContext"),
             resp["detector"].get("name"),
             resp["detector"].get("uuid"),
-            Confidence[resp["confidence"]],
+            _CONFIDENCE_BY_NAME[resp["confidence"]],
             Range(resp["location"]["byteRange"]["start"], resp["location"]["byteRange"]["end"]),
             Range(resp["location"]["codepointRange"]["start"], resp["location"]["codepointRange"]["end"]),
             _range_or_none(resp["location"]["rowRange"]),
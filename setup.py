@@ -34,5 +34,8 @@ setup(
         'requests',
         'urllib3'
     ],
+    extras_require={
+        'orjson': ['orjson']
+    },
     python_requires='~=3.7'
 )
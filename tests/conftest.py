@@ -0,0 +1,16 @@
+import pytest
+import responses
+from responses.registries import OrderedRegistry
+
+
+@pytest.fixture
+def mocked_responses():
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        yield rsps
+
+
+@pytest.fixture
+def ordered_responses():
+    """Like mocked_responses, but each registered response is consumed exactly once, in registration order."""
+    with responses.RequestsMock(assert_all_requests_are_fired=True, registry=OrderedRegistry) as rsps:
+        yield rsps
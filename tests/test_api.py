@@ -1,10 +1,18 @@
+import contextvars
+import dataclasses
 import json
+import logging
+import operator
 import os
+from pathlib import Path
+import threading
+import time
 
 from freezegun import freeze_time
 import pytest
+import requests
 import responses
-import time
+from responses import matchers
 
 from nightfall.api import Nightfall, NightfallUserError
 from nightfall.detection_rules import DetectionRule, Detector, LogicalOp, Confidence, ExclusionRule, ContextRule, \
@@ -12,72 +20,113 @@ from nightfall.detection_rules import DetectionRule, Detector, LogicalOp, Confid
 from nightfall.findings import Finding, Range
 
 
+_FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+def _load_fixture(name):
+    with open(_FIXTURES_DIR / name, encoding="utf-8") as f:
+        return json.load(f)
+
+
+_MASK = "👀"
+_MASKED_CC = f"491{_MASK}-{_MASK * 4}-{_MASK * 4}-{_MASK * 4}"
+_REDACTED_TEXT = f"{_MASKED_CC} is my credit card number, [REDACTED] ssn"
+_CC_DETECTOR = Detector(min_confidence=Confidence.LIKELY,
+                        min_num_findings=1,
+                        display_name="Credit Card Number",
+                        nightfall_detector="CREDIT_CARD_NUMBER",
+                        context_rules=[ContextRule(regex=Regex("fake regex", is_case_sensitive=False),
+                                                   window_before=10, window_after=10,
+                                                   fixed_confidence=Confidence.VERY_UNLIKELY)],
+                        exclusion_rules=[ExclusionRule(MatchType.FULL,
+                                                       word_list=WordList(["never", "match"], is_case_sensitive=True))],
+                        redaction_config=RedactionConfig(remove_finding=False,
+                                                         mask_config=MaskConfig(masking_char=_MASK,
+                                                                                num_chars_to_leave_unmasked=3,
+                                                                                chars_to_ignore=["-"])),
+                        )
+_SSN_DETECTOR = Detector(min_confidence=Confidence.LIKELY, nightfall_detector="US_SOCIAL_SECURITY_NUMBER")
+_DETECTION_RULE = DetectionRule(logical_op=LogicalOp.ANY, detectors=[_CC_DETECTOR, _SSN_DETECTOR])
+_DEFAULT_REDACTION_CONFIG = RedactionConfig(remove_finding=False, substitution_phrase="[REDACTED]")
+
+
+# Expected findings for the shared credit card + SSN scan; tests fill in the detector UUID from the response.
+_CC_FINDING = Finding(
+    "4916-6734-7572-5015",
+    _MASKED_CC,
+    None, " is my cre",
+    "Credit Card Number",
+    None,
+    Confidence.VERY_LIKELY,
+    Range(0, 19), Range(0, 19), None, None, "", "",
+    [], ["Inline Detection Rule #1"])
+_SSN_FINDING = Finding(
+    "489-36-8350",
+    "[REDACTED]",
+    "d number, ", " ssn",
+    "US_SOCIAL_SECURITY_NUMBER",
+    None,
+    Confidence.VERY_LIKELY,
+    Range(46, 57), Range(46, 57), None, None, "", "",
+    [], ["Inline Detection Rule #1"])
+
+_SCAN_TEXT_RESPONSE = _load_fixture("scan_text_response.json")
+_SCAN_TEXT_REQUEST = _load_fixture("scan_text_request.json")
+_SCAN_TEXT_POLICY_UUIDS_RESPONSE = _load_fixture("scan_text_policy_uuids_response.json")
+
+
+_WEBHOOK_SIGNING_SECRET = "super-secret-shhhh"
+_WEBHOOK_TIMESTAMP = 1633368645
+_WEBHOOK_BODY = "hello world foo bar goodnight moon"
+# Known-good HMAC-SHA256 of "<timestamp>:<body>" keyed with the signing secret.
+_WEBHOOK_SIGNATURE = "1bb7619a9504474ffc14086d0423ad15db42606d3ca52afccb4a5b2125d7b703"
+
+
+@pytest.fixture(scope="session")
+def shared_nightfall():
+    return Nightfall(os.environ.get('NIGHTFALL_API_KEY', 'NF-NOT_REAL'))
+
+
 @pytest.fixture
-def nightfall():
-    yield Nightfall(os.environ['NIGHTFALL_API_KEY'])
+def nightfall(shared_nightfall):
+    signing_secret = shared_nightfall.signing_secret
+    yield shared_nightfall
+    shared_nightfall.signing_secret = signing_secret
+
+
+@pytest.fixture(params=["orjson", "json"])
+def json_codec(request, monkeypatch):
+    """Run the test once with orjson and once with the stdlib json fallback used when it is not installed."""
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr("nightfall.api.orjson", None)
+    return request.param
 
 
 @pytest.mark.integration
 def test_scan_text_detection_rules_v3(nightfall):
     result, redactions = nightfall.scan_text(
         ["4916-6734-7572-5015 is my credit card number, 489-36-8350 ssn"],
-        detection_rules=[
-            DetectionRule(logical_op=LogicalOp.ANY, detectors=[
-                    Detector(min_confidence=Confidence.LIKELY,
-                             min_num_findings=1,
-                             display_name="Credit Card Number",
-                             nightfall_detector="CREDIT_CARD_NUMBER",
-                             context_rules=[ContextRule(regex=Regex("fake regex", is_case_sensitive=False),
-                                                        window_before=10, window_after=10,
-                                                        fixed_confidence=Confidence.VERY_UNLIKELY)],
-                             exclusion_rules=[ExclusionRule(MatchType.FULL,
-                                                            word_list=WordList(["never", "match"],
-                                                                               is_case_sensitive=True))],
-                             redaction_config=RedactionConfig(remove_finding=False,
-                                                              mask_config=MaskConfig(masking_char='👀',
-                                                                                     num_chars_to_leave_unmasked=3,
-                                                                                     chars_to_ignore=["-"])),
-                             ),
-                    Detector(min_confidence=Confidence.LIKELY, nightfall_detector="US_SOCIAL_SECURITY_NUMBER")])],
+        detection_rules=[_DETECTION_RULE],
         context_bytes=10,
-        default_redaction_config=RedactionConfig(remove_finding=False, substitution_phrase="[REDACTED]")
+        default_redaction_config=_DEFAULT_REDACTION_CONFIG
     )
 
-    assert len(result) == 1
-    assert len(result[0]) == 2
-
-    def finding_orderer(f):
-        return f.codepoint_range.start
-
-    result[0].sort(key=finding_orderer)
-    assert result[0][0] == Finding(
-        "4916-6734-7572-5015",
-        "491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀",
-        None, " is my cre",
-        "Credit Card Number",
-        result[0][0].detector_uuid,
-        Confidence.VERY_LIKELY,
-        Range(0, 19), Range(0, 19), None, None, "", "",
-        [], ["Inline Detection Rule #1"])
-    assert result[0][1] == Finding(
-        "489-36-8350",
-        "[REDACTED]",
-        "d number, ", " ssn",
-        "US_SOCIAL_SECURITY_NUMBER",
-        result[0][1].detector_uuid,
-        Confidence.VERY_LIKELY,
-        Range(46, 57), Range(46, 57), None, None, "", "",
-        [], ["Inline Detection Rule #1"])
-    assert len(redactions) == 1
-    assert redactions[0] == "491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀 is my credit card number, [REDACTED] ssn"
+    result[0].sort(key=operator.attrgetter("codepoint_range.start"))
+    assert result == [[
+        dataclasses.replace(_CC_FINDING, detector_uuid=result[0][0].detector_uuid),
+        dataclasses.replace(_SSN_FINDING, detector_uuid=result[0][1].detector_uuid),
+    ]]
+    assert redactions == [_REDACTED_TEXT]
 
 
 @pytest.mark.filetest
 @pytest.mark.integration
-def test_scan_file_detection_rules(nightfall, tmpdir):
-    file = tmpdir.mkdir("test_data").join("file.txt")
+def test_scan_file_detection_rules(nightfall, tmp_path):
+    file = tmp_path / "file.txt"
 
-    file.write("4916-6734-7572-5015 is my credit card number")
+    file.write_text("4916-6734-7572-5015 is my credit card number")
 
     id, message = nightfall.scan_file(
         file,
@@ -91,446 +140,340 @@ def test_scan_file_detection_rules(nightfall, tmpdir):
     assert message == 'scan initiated'
 
 
-@responses.activate
-def test_scan_text():
+def test_scan_text(mocked_responses, json_codec):
     nightfall = Nightfall("NF-NOT_REAL")
-    responses.add(responses.POST, 'https://api.nightfall.ai/v3/scan',
-                  json={
-                      "findings":
-                          [
-                              [
-                                  {
-                                      "finding": "4916-6734-7572-5015",
-                                      "redactedFinding": "491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀",
-                                      "afterContext": " is my cre",
-                                      "detector":
-                                          {
-                                              "name": "Credit Card Number",
-                                              "uuid": "74c1815e-c0c3-4df5-8b1e-6cf98864a454"
-                                          },
-                                      "confidence": "VERY_LIKELY",
-                                      "location":
-                                          {
-                                              "byteRange":
-                                                  {
-                                                      "start": 0,
-                                                      "end": 19
-                                                  },
-                                              "codepointRange":
-                                                  {
-                                                      "start": 0,
-                                                      "end": 19
-                                                  },
-                                              "rowRange": None,
-                                              "columnRange": None,
-                                          },
-                                      "redactedLocation":
-                                          {
-                                              "byteRange":
-                                                  {
-                                                      "start": 0,
-                                                      "end": 19
-                                                  },
-                                              "codepointRange":
-                                                  {
-                                                      "start": 0,
-                                                      "end": 19
-                                                  },
-                                              "rowRange": None,
-                                              "columnRange": None,
-                                          },
-                                      "matchedDetectionRuleUUIDs":
-                                          [],
-                                      "matchedDetectionRules":
-                                          [
-                                              "Inline Detection Rule #1"
-                                          ]
-                                  },
-                                  {
-                                      "finding": "489-36-8350",
-                                      "redactedFinding": "[REDACTED]",
-                                      "beforeContext": "d number, ",
-                                      "afterContext": " ssn",
-                                      "detector":
-                                          {
-                                              "name": "",
-                                              "uuid": "e30d9a87-f6c7-46b9-a8f4-16547901e069"
-                                          },
-                                      "confidence": "VERY_LIKELY",
-                                      "location":
-                                          {
-                                              "byteRange":
-                                                  {
-                                                      "start": 46,
-                                                      "end": 57
-                                                  },
-                                              "codepointRange":
-                                                  {
-                                                      "start": 46,
-                                                      "end": 57
-                                                  },
-                                              "rowRange":
-                                                  {
-                                                      "start": 2,
-                                                      "end": 4,
-                                                  },
-                                              "columnRange": 
-                                                  {
-                                                      "start": 1,
-                                                      "end": 1,
-                                                  },
-                                          },
-                                      "redactedLocation":
-                                          {
-                                              "byteRange":
-                                                  {
-                                                      "start": 46,
-                                                      "end": 56
-                                                  },
-                                              "codepointRange":
-                                                  {
-                                                      "start": 46,
-                                                      "end": 56
-                                                  },
-                                              "rowRange": None,
-                                              "columnRange": None,
-                                          },
-                                      "matchedDetectionRuleUUIDs":
-                                          [],
-                                      "matchedDetectionRules":
-                                          [
-                                              "Inline Detection Rule #1"
-                                          ]
-                                  }
-                              ]
-                          ],
-                      "redactedPayload":
-                          [
-                              "491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀 is my credit card number, [REDACTED] ssn"
-                          ]
-                  })
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/scan', json=_SCAN_TEXT_RESPONSE,
+                         match=[matchers.json_params_matcher(_SCAN_TEXT_REQUEST)])
     result, redactions = nightfall.scan_text(
         ["4916-6734-7572-5015 is my credit card number, 489-36-8350 ssn"],
-        detection_rules=[
-            DetectionRule(logical_op=LogicalOp.ANY, detectors=[
-                    Detector(min_confidence=Confidence.LIKELY,
-                             min_num_findings=1,
-                             display_name="Credit Card Number",
-                             nightfall_detector="CREDIT_CARD_NUMBER",
-                             context_rules=[ContextRule(regex=Regex("fake regex", is_case_sensitive=False),
-                                                        window_before=10, window_after=10,
-                                                        fixed_confidence=Confidence.VERY_UNLIKELY)],
-                             exclusion_rules=[ExclusionRule(MatchType.FULL,
-                                                            word_list=WordList(["never", "match"],
-                                                                               is_case_sensitive=True))],
-                             redaction_config=RedactionConfig(remove_finding=False,
-                                                              mask_config=MaskConfig(masking_char='👀',
-                                                                                     num_chars_to_leave_unmasked=3,
-                                                                                     chars_to_ignore=["-"])),
-                             ),
-                    Detector(min_confidence=Confidence.LIKELY, nightfall_detector="US_SOCIAL_SECURITY_NUMBER")])],
+        detection_rules=[_DETECTION_RULE],
         context_bytes=10,
-        default_redaction_config=RedactionConfig(remove_finding=False, substitution_phrase="[REDACTED]")
+        default_redaction_config=_DEFAULT_REDACTION_CONFIG
     )
 
-    assert len(responses.calls) == 1
-    assert responses.calls[0].request.headers.get("Authorization") == "Bearer NF-NOT_REAL"
-    assert json.loads(responses.calls[0].request.body) == {
-        "payload":
-            [
-                "4916-6734-7572-5015 is my credit card number, 489-36-8350 ssn"
-            ],
-        "policy":
-            {
-                "detectionRules":
-                    [
-                        {
-                            "detectors":
-                                [
-                                    {
-                                        "minConfidence": "LIKELY",
-                                        "minNumFindings": 1,
-                                        "nightfallDetector": "CREDIT_CARD_NUMBER",
-                                        "detectorType": "NIGHTFALL_DETECTOR",
-                                        "displayName": "Credit Card Number",
-                                        "contextRules":
-                                            [
-                                                {
-                                                    "regex":
-                                                        {
-                                                            "pattern": "fake regex",
-                                                            "isCaseSensitive": False
-                                                        },
-                                                    "proximity":
-                                                        {
-                                                            "windowBefore": 10,
-                                                            "windowAfter": 10
-                                                        },
-                                                    "confidenceAdjustment":
-                                                        {
-                                                            "fixedConfidence": "VERY_UNLIKELY"
-                                                        }
-                                                }
-                                            ],
-                                        "exclusionRules":
-                                            [
-                                                {
-                                                    "matchType": "FULL",
-                                                    "wordList":
-                                                        {
-                                                            "values":
-                                                                [
-                                                                    "never",
-                                                                    "match"
-                                                                ],
-                                                            "isCaseSensitive": True
-                                                        },
-                                                    "exclusionType": "WORD_LIST"
-                                                }
-                                            ],
-                                        "redactionConfig":
-                                            {
-                                                "removeFinding": False,
-                                                "maskConfig":
-                                                    {
-                                                        "maskingChar": "👀",
-                                                        "numCharsToLeaveUnmasked": 3,
-                                                        "maskRightToLeft": False,
-                                                        "charsToIgnore":
-                                                            [
-                                                                "-"
-                                                            ]
-                                                    }
-                                            }
-                                    },
-                                    {
-                                        "minConfidence": "LIKELY",
-                                        "minNumFindings": 1,
-                                        "nightfallDetector": "US_SOCIAL_SECURITY_NUMBER",
-                                        "detectorType": "NIGHTFALL_DETECTOR"
-                                    }
-                                ],
-                            "logicalOp": "ANY"
-                        }
-                    ],
-                "contextBytes": 10,
-                "defaultRedactionConfig":
-                    {
-                        "removeFinding": False,
-                        "substitutionConfig":
-                            {
-                                "substitutionPhrase": "[REDACTED]"
-                            }
-                    }
-            }
-    }
+    assert len(mocked_responses.calls) == 1
+    assert mocked_responses.calls[0].request.headers.get("Authorization") == "Bearer NF-NOT_REAL"
+
+    assert result == [[
+        dataclasses.replace(_CC_FINDING, detector_uuid=result[0][0].detector_uuid),
+        dataclasses.replace(_SSN_FINDING, detector_name="", detector_uuid=result[0][1].detector_uuid,
+                            row_range=Range(2, 4), column_range=Range(1, 1)),
+    ]]
+    assert redactions == [_REDACTED_TEXT]
 
-    assert len(result) == 1
-    assert len(result[0]) == 2
-    assert result[0][0] == Finding(
-        "4916-6734-7572-5015",
-        '491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀',
-        None, " is my cre",
-        "Credit Card Number",
-        result[0][0].detector_uuid,
-        Confidence.VERY_LIKELY,
-        Range(0, 19), Range(0, 19),  None, None, "", "",
-        [], ["Inline Detection Rule #1"])
-    assert result[0][1] == Finding(
-        "489-36-8350",
-        "[REDACTED]",
-        "d number, ", " ssn",
-        "",
-        result[0][1].detector_uuid,
-        Confidence.VERY_LIKELY,
-        Range(46, 57), Range(46, 57), Range(2,4), Range(1,1), "", "",
-        [], ["Inline Detection Rule #1"])
-    assert len(redactions) == 1
-    assert redactions[0] == "491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀 is my credit card number, [REDACTED] ssn"
-
-@responses.activate
-def test_scan_text_with_policy_uuids():
+
+def test_scan_text_with_policy_uuids(mocked_responses, json_codec):
     nightfall = Nightfall("NF-NOT_REAL")
-    responses.add(responses.POST, 'https://api.nightfall.ai/v3/scan',
-                  json={
-                      "findings":
-                          [
-                              [
-                                  {
-                                      "finding": "4916-6734-7572-5015",
-                                      "redactedFinding": "491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀",
-                                      "afterContext": " is my cre",
-                                      "detector":
-                                          {
-                                              "name": "Credit Card Number",
-                                              "uuid": "74c1815e-c0c3-4df5-8b1e-6cf98864a454"
-                                          },
-                                      "confidence": "VERY_LIKELY",
-                                      "location":
-                                          {
-                                              "byteRange":
-                                                  {
-                                                      "start": 0,
-                                                      "end": 19
-                                                  },
-                                              "codepointRange":
-                                                  {
-                                                      "start": 0,
-                                                      "end": 19
-                                                  },
-                                              "rowRange": None,
-                                              "columnRange": None,
-                                          },
-                                      "redactedLocation":
-                                          {
-                                              "byteRange":
-                                                  {
-                                                      "start": 0,
-                                                      "end": 19
-                                                  },
-                                              "codepointRange":
-                                                  {
-                                                      "start": 0,
-                                                      "end": 19
-                                                  },
-                                              "rowRange": None,
-                                              "columnRange": None,
-                                          },
-                                      "matchedDetectionRuleUUIDs":
-                                          ["0d8efd7b-b87a-478b-984e-9cf5534a46bc"],
-                                      "matchedDetectionRules":
-                                          []
-                                  },
-                              ]
-                          ],
-                      "redactedPayload":
-                          [
-                              "491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀 is my credit card number, [REDACTED] ssn"
-                          ]
-                  })
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/scan', json=_SCAN_TEXT_POLICY_UUIDS_RESPONSE,
+                         match=[matchers.json_params_matcher({
+                             "payload": ["4916-6734-7572-5015 is my credit card number, 489-36-8350 ssn"],
+                             "policyUUIDs": ["2388f83f-cd31-4689-971b-4ee94f798281"],
+                         })])
     result, redactions = nightfall.scan_text(
         ["4916-6734-7572-5015 is my credit card number, 489-36-8350 ssn"],
         policy_uuids=["2388f83f-cd31-4689-971b-4ee94f798281"]
     )
 
-    assert len(responses.calls) == 1
-    assert responses.calls[0].request.headers.get("Authorization") == "Bearer NF-NOT_REAL"
-    assert json.loads(responses.calls[0].request.body) == {
-        "payload":
-            [
-                "4916-6734-7572-5015 is my credit card number, 489-36-8350 ssn"
-            ],
-        "policyUUIDs": ["2388f83f-cd31-4689-971b-4ee94f798281"]
+    assert len(mocked_responses.calls) == 1
+    assert mocked_responses.calls[0].request.headers.get("Authorization") == "Bearer NF-NOT_REAL"
+
+    assert result == [[
+        dataclasses.replace(_CC_FINDING, detector_uuid=result[0][0].detector_uuid,
+                            matched_detection_rule_uuids=["0d8efd7b-b87a-478b-984e-9cf5534a46bc"],
+                            matched_detection_rules=[]),
+    ]]
+    assert redactions == [_REDACTED_TEXT]
+
+
+def test_scan_text_lone_surrogate(mocked_responses, json_codec):
+    # surrogateescape decoding of non-UTF-8 input leaves lone surrogates, which must still be sent.
+    nightfall = Nightfall("NF-NOT_REAL")
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/scan', json={"findings": [[]]})
+
+    result, redactions = nightfall.scan_text(["abc\udcff"], detection_rule_uuids=["a_uuid"])
+
+    assert len(mocked_responses.calls) == 1
+    assert json.loads(mocked_responses.calls[0].request.body) == {
+        "payload": ["abc\udcff"],
+        "policy": {"detectionRuleUUIDs": ["a_uuid"]},
     }
+    assert result == [[]]
+
+
+def test_scan_text_malformed_response(mocked_responses, json_codec):
+    nightfall = Nightfall("NF-NOT_REAL")
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/scan', body="not json")
+
+    with pytest.raises(requests.exceptions.JSONDecodeError) as excinfo:
+        nightfall.scan_text(["hello world"], detection_rule_uuids=["a_uuid"])
+    assert isinstance(excinfo.value, requests.RequestException)
 
-    assert len(result) == 1
-    assert len(result[0]) == 1
-    assert result[0][0] == Finding(
-        "4916-6734-7572-5015",
-        '491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀',
-        None, " is my cre",
-        "Credit Card Number",
-        result[0][0].detector_uuid,
-        Confidence.VERY_LIKELY,
-        Range(0, 19), Range(0, 19), None, None, "", "",
-        ["0d8efd7b-b87a-478b-984e-9cf5534a46bc"], [])
-    assert len(redactions) == 1
-    assert redactions[0] == "491👀-👀👀👀👀-👀👀👀👀-👀👀👀👀 is my credit card number, [REDACTED] ssn"
-
-def test_scan_text_no_detection_rules_or_policy_uuids():
+
+def test_scan_text_debug_logging(mocked_responses, caplog, monkeypatch):
+    nightfall = Nightfall("NF-NOT_REAL")
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/scan', json={"findings": [[]]})
+
+    text_reads = []
+    response_text = requests.Response.text
+
+    def counting_text(response):
+        text_reads.append(response)
+        return response_text.fget(response)
+
+    monkeypatch.setattr(requests.Response, "text", property(counting_text))
+
+    nightfall.scan_text(["hello world"], detection_rule_uuids=["a_uuid"])
+    assert caplog.records == []
+    assert text_reads == []
+
+    with caplog.at_level(logging.DEBUG, logger="nightfall.api"):
+        nightfall.scan_text(["hello world"], detection_rule_uuids=["a_uuid"])
+    # The whole response body is never decoded for logging, only the logged prefix.
+    assert text_reads == []
+    assert "HTTP Status Code: 200" in caplog.messages
+    assert 'HTTP Response Text (18 bytes): {"findings": [[]]}' in caplog.messages
+
+    caplog.clear()
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/scan', json={"findings": [[]], "pad": "x" * 4096})
+    with caplog.at_level(logging.DEBUG, logger="nightfall.api"):
+        nightfall.scan_text(["y" * 4096], detection_rule_uuids=["a_uuid"])
+    assert all(len(m) < 1100 for m in caplog.messages)
+
+
+def test_scan_text_no_detection_rules_or_policy_uuids(mocked_responses):
     nightfall = Nightfall("NF-NOT_REAL")
     with pytest.raises(NightfallUserError):
         nightfall.scan_text(texts=["will", "fail"])
+    assert len(mocked_responses.calls) == 0
 
 
-@responses.activate
-def test_scan_file(tmpdir):
-    file = tmpdir.mkdir("test_data").join("file.txt")
+def test_scan_file(tmp_path, ordered_responses, json_codec):
+    file = tmp_path / "file.txt"
 
-    file.write("4916-6734-7572-5015 is my credit card number")
+    file.write_text("4916-6734-7572-5015 is my credit card number")
 
     nightfall = Nightfall("NF-NOT_REAL")
-    responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload', status=200, json={"id": 1, "chunkSize": 22})
-    responses.add(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', status=204)
-    responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload/1/finish', status=200)
-    responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload/1/scan', status=200,
-                  json={"id": 1, "message": "scan_started"})
+    ordered_responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload', status=200,
+                          json={"id": 1, "chunkSize": 22},
+                          match=[matchers.json_params_matcher({"fileSizeBytes": 44})])
+    ordered_responses.add(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', status=204)
+    ordered_responses.add(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', status=204)
+    ordered_responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload/1/finish', status=200)
+    ordered_responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload/1/scan', status=200,
+                          json={"id": 1, "message": "scan_started"},
+                          match=[matchers.json_params_matcher({
+                              "policy": {
+                                  "webhookURL": "https://my-website.example/callback",
+                                  "detectionRuleUUIDs": ["a_uuid"],
+                              },
+                              "requestMetadata": "some test data",
+                          })])
 
     id, message = nightfall.scan_file(file, "https://my-website.example/callback", detection_rule_uuids=["a_uuid"],
                                       request_metadata="some test data")
 
-    assert len(responses.calls) == 5
-    for call in responses.calls:
+    assert len(ordered_responses.calls) == 5
+    for call in ordered_responses.calls:
         assert call.request.headers.get("Authorization") == "Bearer NF-NOT_REAL"
 
-    assert responses.calls[0].request.body == b'{"fileSizeBytes": 44}'
-    assert responses.calls[1].request.body == b"4916-6734-7572-5015 is"
-    assert responses.calls[1].request.headers.get("X-UPLOAD-OFFSET") == '0'
-    assert responses.calls[2].request.body == b" my credit card number"
-    assert responses.calls[2].request.headers.get("X-UPLOAD-OFFSET") == '22'
-    assert responses.calls[4].request.body == b'{"policy": {"webhookURL": "https://my-website.example/callback", ' \
-                                              b'"detectionRuleUUIDs": ["a_uuid"]}, "requestMetadata": "some test data"}'
+    assert ordered_responses.calls[1].request.body == b"4916-6734-7572-5015 is"
+    assert ordered_responses.calls[1].request.headers.get("X-UPLOAD-OFFSET") == '0'
+    assert ordered_responses.calls[2].request.body == b" my credit card number"
+    assert ordered_responses.calls[2].request.headers.get("X-UPLOAD-OFFSET") == '22'
     assert id == 1
     assert message == "scan_started"
 
 
-@responses.activate
-def test_file_scan_upload_short(tmpdir):
-    file = tmpdir.mkdir("test_data").join("file.txt")
+@pytest.mark.parametrize("malformed", ["upload", "scan"])
+def test_scan_file_malformed_response(tmp_path, mocked_responses, json_codec, malformed):
+    file = tmp_path / "file.txt"
 
-    file.write("4916-6734-7572-5015 is my credit card number")
+    file.write_text("4916-6734-7572-5015 is my credit card number")
 
     nightfall = Nightfall("NF-NOT_REAL")
+    if malformed == "upload":
+        mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload', status=200, body="not json")
+    else:
+        mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload', status=200,
+                             json={"id": 1, "chunkSize": 44})
+    mocked_responses.add(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', status=204)
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload/1/finish', status=200)
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload/1/scan', status=200, body="not json")
 
-    responses.add(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', status=204)
+    with pytest.raises(requests.exceptions.JSONDecodeError) as excinfo:
+        nightfall.scan_file(file, "https://my-website.example/callback", detection_rule_uuids=["a_uuid"])
+    assert isinstance(excinfo.value, requests.RequestException)
 
-    assert nightfall._file_scan_upload(1, file, 200)
-    assert len(responses.calls) == 1
-    assert responses.calls[0].request.headers.get("Authorization") == "Bearer NF-NOT_REAL"
-    assert responses.calls[0].request.body == b"4916-6734-7572-5015 is my credit card number"
-    assert responses.calls[0].request.headers.get("X-UPLOAD-OFFSET") == "0"
 
+def test_scan_file_no_detection_rules_or_policy_uuid(tmp_path, mocked_responses):
+    file = tmp_path / "file.txt"
 
-@responses.activate
-def test_file_scan_upload_long(tmpdir):
-    file = tmpdir.mkdir("test_data").join("file.txt")
+    file.write_text("4916-6734-7572-5015 is my credit card number")
+
+    nightfall = Nightfall("NF-NOT_REAL")
+    with pytest.raises(NightfallUserError):
+        nightfall.scan_file(file, "https://my-website.example/callback")
+    assert len(mocked_responses.calls) == 0
+
+
+@pytest.mark.parametrize("concurrency", [1, 8])
+@pytest.mark.parametrize("chunk_size,expected_calls", [(1, 44), (8, 6), (22, 2), (200, 1)])
+def test_file_scan_upload(tmp_path, mocked_responses, chunk_size, expected_calls, concurrency):
+    file = tmp_path / "file.txt"
     test_str = b"4916-6734-7572-5015 is my credit card number"
-    file.write_binary(test_str)
+    file.write_bytes(test_str)
 
-    responses.add(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', status=204)
+    mocked_responses.add(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', status=204)
 
-    nightfall = Nightfall("NF-NOT_REAL")
+    nightfall = Nightfall("NF-NOT_REAL", file_upload_concurrency=concurrency)
 
-    assert nightfall._file_scan_upload(1, file, 1)
-    assert len(responses.calls) == 44
-    for i, call in enumerate(responses.calls):
+    assert nightfall._file_scan_upload(1, file, chunk_size)
+    assert len(mocked_responses.calls) == expected_calls
+    calls = list(mocked_responses.calls)
+    if concurrency > 1:
+        # Parallel uploads may complete in any order.
+        calls.sort(key=lambda c: int(c.request.headers.get("X-UPLOAD-OFFSET")))
+    for call, offset in zip(calls, range(0, len(test_str), chunk_size)):
         assert call.request.headers.get("Authorization") == "Bearer NF-NOT_REAL"
-        assert call.request.body.decode('utf-8') == test_str.decode('utf-8')[i]
-        assert call.request.headers.get("X-UPLOAD-OFFSET") == str(i)
-
-
-@freeze_time("2021-10-04T17:30:50Z")
-def test_validate_webhook(nightfall):
-    nightfall.signing_secret = "super-secret-shhhh"
-    timestamp = 1633368645
-    body = "hello world foo bar goodnight moon"
-    expected = "1bb7619a9504474ffc14086d0423ad15db42606d3ca52afccb4a5b2125d7b703"
-    assert nightfall.validate_webhook(expected, timestamp, body)
-
-
-@freeze_time("2021-10-04T19:30:50Z")
-def test_validate_webhook_too_old(nightfall):
-    nightfall.signing_secret = "super-secret-shhhh"
-    timestamp = 1633368645
-    body = "hello world foo bar goodnight moon"
-    expected = "1bb7619a9504474ffc14086d0423ad15db42606d3ca52afccb4a5b2125d7b703"
-    assert not nightfall.validate_webhook(expected, timestamp, body)
-
-
-@freeze_time("2021-10-04T17:30:50Z")
-def test_validate_webhook_incorrect_sig(nightfall):
-    nightfall.signing_secret = "super-secret-shhhh"
-    timestamp = 1633368645
-    body = "hello world foo bar goodnight moon"
-    expected = "not matching"
-    assert not nightfall.validate_webhook(expected, timestamp, body)
+        assert call.request.headers.get("X-UPLOAD-OFFSET") == str(offset)
+        assert call.request.body == test_str[offset:offset + chunk_size]
+
+
+_TRACE_ID = contextvars.ContextVar("trace_id", default=None)
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_file_scan_upload_keeps_caller_context(tmp_path, mocked_responses, monkeypatch, concurrency):
+    file = tmp_path / "file.txt"
+    file.write_bytes(b"4916-6734-7572-5015 is my credit card number")
+    mocked_responses.add(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', status=204)
+
+    nightfall = Nightfall("NF-NOT_REAL", file_upload_concurrency=concurrency)
+    seen = []
+    session_patch = nightfall.session.patch
+
+    def patch(*args, **kwargs):
+        seen.append((threading.current_thread(), _TRACE_ID.get()))
+        return session_patch(*args, **kwargs)
+
+    monkeypatch.setattr(nightfall.session, "patch", patch)
+    token = _TRACE_ID.set("abc123")
+    try:
+        assert nightfall._file_scan_upload(1, file, 8)
+    finally:
+        _TRACE_ID.reset(token)
+    assert len(seen) == 6
+    assert all(trace_id == "abc123" for _, trace_id in seen)
+    if concurrency == 1:
+        # The default path uploads sequentially on the caller's thread.
+        assert all(thread is threading.current_thread() for thread, _ in seen)
+
+
+def test_file_scan_upload_runs_concurrently(tmp_path, mocked_responses):
+    file = tmp_path / "file.txt"
+    file.write_bytes(b"4916-6734-7572-5015 is my credit card number")
+
+    # Both chunk uploads must be in flight at the same time to get past the barrier.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def callback(request):
+        barrier.wait()
+        return 204, {}, ""
+
+    mocked_responses.add_callback(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', callback=callback)
+
+    nightfall = Nightfall("NF-NOT_REAL", file_upload_concurrency=2)
+
+    assert nightfall._file_scan_upload(1, file, 22)
+    assert len(mocked_responses.calls) == 2
+
+
+def test_scan_file_upload_failure_concurrent(tmp_path, mocked_responses):
+    file = tmp_path / "file.txt"
+    file.write_text("4916-6734-7572-5015 is my credit card number")
+
+    def callback(request):
+        if request.headers["X-UPLOAD-OFFSET"] == "16":
+            return 400, {}, json.dumps({"code": 40000, "message": "Bad Request"})
+        return 204, {}, ""
+
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload', status=200,
+                         json={"id": 1, "chunkSize": 8})
+    mocked_responses.add_callback(responses.PATCH, 'https://api.nightfall.ai/v3/upload/1', callback=callback)
+    mocked_responses.add(responses.POST, 'https://api.nightfall.ai/v3/upload/1/finish', status=200)
+
+    nightfall = Nightfall("NF-NOT_REAL", file_upload_concurrency=4)
+    with pytest.raises(NightfallUserError):
+        nightfall.scan_file(file, "https://my-website.example/callback", detection_rule_uuids=["a_uuid"])
+
+    assert not [c for c in mocked_responses.calls if c.request.url.endswith("/finish")]
+
+
+@pytest.mark.parametrize("concurrency", [1, 2, 4])
+def test_file_scan_upload_bounds_chunks_in_memory(tmp_path, monkeypatch, concurrency):
+    file = tmp_path / "file.bin"
+    file.write_bytes(b"x" * 200)
+
+    lock = threading.Lock()
+    live, peak = [0], [0]
+
+    class Chunk(bytes):
+        def __del__(self):
+            with lock:
+                live[0] -= 1
+
+    class CountingFile:
+        def __init__(self, path, mode):
+            self.fp = open(path, mode)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.fp.close()
+
+        def read(self, size):
+            data = self.fp.read(size)
+            if not data:
+                return data
+            with lock:
+                live[0] += 1
+                peak[0] = max(peak[0], live[0])
+            return Chunk(data)
+
+    class NoContent:
+        status_code = 204
+
+    def patch(url, data, headers):
+        time.sleep(0.001)
+        return NoContent()
+
+    monkeypatch.setattr("nightfall.api.open", CountingFile, raising=False)
+    nightfall = Nightfall("NF-NOT_REAL", file_upload_concurrency=concurrency)
+    monkeypatch.setattr(nightfall.session, "patch", patch)
+
+    assert nightfall._file_scan_upload(1, file, 10)
+    assert peak[0] == concurrency
+
+
+def test_file_upload_concurrency_invalid():
+    with pytest.raises(NightfallUserError):
+        Nightfall("NF-NOT_REAL", file_upload_concurrency=0)
+
+
+def test_context_manager_closes_session(monkeypatch):
+    closed = []
+    with Nightfall("NF-NOT_REAL") as nightfall:
+        monkeypatch.setattr(nightfall.session, "close", lambda: closed.append(True))
+    assert closed == [True]
+
+
+@pytest.mark.parametrize("now,signature,expected", [
+    ("2021-10-04T17:30:50Z", _WEBHOOK_SIGNATURE, True),
+    ("2021-10-04T19:30:50Z", _WEBHOOK_SIGNATURE, False),
+    ("2021-10-04T17:30:50Z", "not matching", False),
+], ids=["valid", "too_old", "incorrect_sig"])
+def test_validate_webhook(nightfall, now, signature, expected):
+    nightfall.signing_secret = _WEBHOOK_SIGNING_SECRET
+    with freeze_time(now):
+        assert nightfall.validate_webhook(signature, _WEBHOOK_TIMESTAMP, _WEBHOOK_BODY) == expected